@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+
+# Gunicorn configuration: gunicorn -c gunicorn_conf.py main:app
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+
+def _available_cpus():
+    """CPUs this container may use, honouring a cgroup CPU quota"""
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+    try:
+        # cgroup v2: "<quota> <period>", quota is "max" when unlimited
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+    except OSError:
+        try:
+            # cgroup v1: quota is -1 when unlimited
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = f.read().strip()
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = f.read().strip()
+        except OSError:
+            return max(1, cpus)
+    if quota not in ("max", "-1"):
+        cpus = min(cpus, int(quota) // int(period))
+    return max(1, cpus)
+
+
+# One event loop per worker process, one worker per available CPU; async
+# workers don't need the 2n+1 of sync workers. GIL-bound work (text
+# cleaning, JSON parsing) runs in parallel across workers. Concurrency
+# limits and the GPT cache in the app are per worker
+workers = int(os.getenv("WEB_CONCURRENCY", _available_cpus()))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Large invoices can take minutes in Form Recognizer + GPT
+timeout = 1800
+graceful_timeout = 1800
+keepalive = 1800
+
+# Load the app in each worker after fork so every worker opens its own
+# Cosmos, Form Recognizer and OpenAI connections
+preload_app = False
@@ -1,13 +1,14 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any
+from typing import List, Optional
 import logging
 import uvicorn
 from datetime import datetime
-import tempfile
 import os
-from shared.invoice_processor import process_invoice_with_gpt
-from shared.cosmos_operations import get_cosmos_manager
+import asyncio
+from shared.invoice_processor import process_invoice_with_gpt, close_clients, get_encoding, GPT_CONFIG_ERRORS
+from shared.cosmos_operations import get_cosmos_manager, close_cosmos_manager
+from shared.models import InvoiceDict
 
 # Enhanced logging configuration
 logging.basicConfig(
@@ -38,6 +39,13 @@ async def startup_event():
     Handles application startup events and verifies service connections
     """
     logger.info("Starting application initialization...")
+    try:
+        # Load the tokenizer now rather than on the first request
+        await asyncio.to_thread(get_encoding)
+        logger.info("Tokenizer loaded")
+    except Exception as e:
+        logger.error(f"Failed to load tokenizer: {str(e)}")
+
     try:
         # Test Cosmos DB connection
         logger.info("Testing Cosmos DB connection...")
@@ -68,6 +76,16 @@ async def startup_event():
 
     logger.info("Application startup completed")
 
+# Shutdown Event Handler
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Releases connections held by service clients
+    """
+    await close_cosmos_manager()
+    await close_clients()
+    logger.info("Application shutdown completed")
+
 # Health Check Endpoint
 @app.get("/health")
 async def health_check():
@@ -92,6 +110,29 @@ async def health_check():
         logger.error(f"Health check failed: {str(e)}")
         raise HTTPException(status_code=500, detail="Health check failed")
 
+async def _upload_stream(file: UploadFile):
+    """Rewind an upload and return its spooled file object"""
+    # Starlette keeps small uploads in memory and spools large ones to disk,
+    # so the stream can go to Form Recognizer without another copy
+    await file.seek(0)
+    return file.file
+
+# Limits how many uploaded files run through Form Recognizer + GPT at once in
+# this worker process; each Gunicorn worker has its own limit
+_file_semaphore = asyncio.Semaphore(int(os.getenv("MAX_PARALLEL_FILES", "8")))
+
+async def _process_upload(file: UploadFile) -> Optional[List[InvoiceDict]]:
+    """Run a single uploaded file through the invoice pipeline"""
+    async with _file_semaphore:
+        logger.info(f"Processing file: {file.filename}")
+        document = await _upload_stream(file)
+        results = await process_invoice_with_gpt(document)
+        if results:
+            logger.info(f"Successfully processed file: {file.filename}")
+        else:
+            logger.warning(f"No invoices found in file: {file.filename}")
+        return results
+
 # Invoice Processing Endpoint
 @app.post("/api/process-invoice/{user_id}")
 async def process_invoice(user_id: str, files: List[UploadFile] = File(...)):
@@ -106,38 +147,28 @@ async def process_invoice(user_id: str, files: List[UploadFile] = File(...)):
         if not files:
             raise HTTPException(status_code=400, detail="No files were uploaded")
 
-        # Process files
+        # Process files concurrently; failures are isolated per file
+        results = await asyncio.gather(
+            *[_process_upload(file) for file in files],
+            return_exceptions=True
+        )
+
         all_invoices = []
         processed_files = 0
         failed_files = 0
 
-        for file in files:
-            try:
-                logger.info(f"Processing file: {file.filename}")
-                content = await file.read()
-                
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    temp_file.write(content)
-                    temp_file_path = temp_file.name
-                
-                try:
-                    # Process the temporary file
-                    results = await process_invoice_with_gpt(temp_file_path)
-                    if results:
-                        all_invoices.extend(results)
-                        processed_files += 1
-                        logger.info(f"Successfully processed file: {file.filename}")
-                    else:
-                        failed_files += 1
-                        logger.warning(f"No invoices found in file: {file.filename}")
-                finally:
-                    # Clean up the temporary file
-                    os.unlink(temp_file_path)
-                    
-            except Exception as e:
+        for file, result in zip(files, results):
+            # Misconfiguration would fail every file; report it as a server error
+            if isinstance(result, GPT_CONFIG_ERRORS):
+                raise result
+            if isinstance(result, Exception):
+                failed_files += 1
+                logger.error(f"Error processing file {file.filename}: {str(result)}")
+            elif result:
+                all_invoices.extend(result)
+                processed_files += 1
+            else:
                 failed_files += 1
-                logger.error(f"Error processing file {file.filename}: {str(e)}")
-                continue
 
         if not all_invoices:
             return {
@@ -171,15 +202,9 @@ async def process_invoice(user_id: str, files: List[UploadFile] = File(...)):
 async def debug_invoice(user_id: str, files: List[UploadFile] = File(...)):
     """Debug endpoint to see raw processing results"""
     try:
-        content = await files[0].read()
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(content)
-            temp_file_path = temp_file.name
-        try:
-            results = await process_invoice_with_gpt(temp_file_path)
-            return {"raw_results": results}
-        finally:
-            os.unlink(temp_file_path)
+        document = await _upload_stream(files[0])
+        results = await process_invoice_with_gpt(document)
+        return {"raw_results": results}
     except Exception as e:
         logger.error(f"Debug endpoint error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
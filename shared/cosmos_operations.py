@@ -1,9 +1,10 @@
 import logging
 import os
 import asyncio
-from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from azure.cosmos import PartitionKey, exceptions
+from azure.cosmos.aio import CosmosClient
 from typing import Optional, List, Dict, Any
-from .models import Invoice
+from .models import InvoiceDict
 
 class CosmosDBManager:
     def __init__(self):
@@ -12,6 +13,8 @@ class CosmosDBManager:
         self.container = None
         self.max_retries = 3
         self.base_delay = 1  # seconds
+        self.max_patch_operations = 10  # Cosmos DB limit per patch request
+        self.max_batch_operations = 100  # Cosmos DB limit per transactional batch
 
     async def initialize(self):
         """Initialize Cosmos DB connection"""
@@ -22,14 +25,12 @@ class CosmosDBManager:
             )
 
             # Create database
-            self.database = await asyncio.to_thread(
-                self.client.create_database_if_not_exists,
+            self.database = await self.client.create_database_if_not_exists(
                 id=os.environ["COSMOS_DATABASE"]
             )
 
             # Create container
-            self.container = await asyncio.to_thread(
-                self.database.create_container_if_not_exists,
+            self.container = await self.database.create_container_if_not_exists(
                 id=os.environ["COSMOS_CONTAINER"],
                 partition_key=PartitionKey(path="/userId"),
                 offer_throughput=400
@@ -39,66 +40,119 @@ class CosmosDBManager:
 
         except Exception as e:
             logging.error(f"Failed to initialize Cosmos DB: {str(e)}")
+            await self.close()
             raise
 
-    async def store_invoices(self, user_id: str, invoices: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Store multiple invoices under the same user_id"""
+    async def close(self):
+        """Close the underlying Cosmos DB client"""
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    async def _with_retry(self, operation, **kwargs):
+        """Run a Cosmos DB operation, backing off exponentially when rate limited"""
         for attempt in range(self.max_retries):
             try:
-                # Check if user document exists
-                user_doc = await self.get_user_document(user_id)
-
-                # The invoices are already dictionaries, no need for to_dict conversion
-                invoices_dicts = invoices
-
-                if user_doc:
-                    # Append new invoices to existing invoices
-                    existing_invoices = user_doc.get('invoices', [])
-                    existing_invoices.extend(invoices_dicts)
-                    user_doc['invoices'] = existing_invoices
-
-                    # Update the user document
-                    response = await asyncio.to_thread(
-                        self.container.replace_item,
-                        item=user_doc,
-                        body=user_doc
-                    )
-                    logging.info(f"Updated invoices for user_id: {user_id}")
-                else:
-                    # Create new user document
-                    user_doc = {
-                        'id': user_id,
-                        'userId': user_id,
-                        'invoices': invoices_dicts
-                    }
-
-                    response = await asyncio.to_thread(
-                        self.container.create_item,
-                        body=user_doc
-                    )
-                    logging.info(f"Created new user document for user_id: {user_id}")
-
-                return response
-
+                return await operation(**kwargs)
             except exceptions.CosmosHttpResponseError as e:
                 if e.status_code == 429 and attempt < self.max_retries - 1:
                     wait_time = self.base_delay * (2 ** attempt)
                     logging.warning(f"Rate limited, waiting {wait_time}s before retry {attempt + 1}")
                     await asyncio.sleep(wait_time)
                     continue
-                else:
-                    logging.error(f"Cosmos DB error: {str(e)}")
-                    raise
-            except Exception as e:
-                logging.error(f"Error storing invoices: {str(e)}")
                 raise
 
+    async def _patch_invoices(self, user_id: str, patches: List[List[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Apply append patches one request at a time"""
+        response = None
+        for patch_operations in patches:
+            response = await self._with_retry(
+                self.container.patch_item,
+                item=user_id,
+                partition_key=user_id,
+                patch_operations=patch_operations
+            )
+        return response
+
+    async def _append_invoices(self, user_id: str, invoices: List[InvoiceDict]) -> Dict[str, Any]:
+        """Append invoices to an existing user document with partial updates"""
+        patches = [
+            [
+                {'op': 'add', 'path': '/invoices/-', 'value': invoice}
+                for invoice in invoices[start:start + self.max_patch_operations]
+            ]
+            for start in range(0, len(invoices), self.max_patch_operations)
+        ]
+
+        response = None
+        for start in range(0, len(patches), self.max_batch_operations):
+            batch_patches = patches[start:start + self.max_batch_operations]
+            if len(batch_patches) == 1:
+                response = await self._patch_invoices(user_id, batch_patches)
+                continue
+
+            # Send up to max_batch_operations patches in one transactional round trip
+            try:
+                results = await self._with_retry(
+                    self.container.execute_item_batch,
+                    batch_operations=[('patch', (user_id, ops)) for ops in batch_patches],
+                    partition_key=user_id
+                )
+                response = results[-1].get('resourceBody')
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code != 404:
+                    raise
+                # The user document doesn't exist yet; let the caller create it
+                raise exceptions.CosmosResourceNotFoundError(
+                    status_code=404,
+                    message=f"User document {user_id} not found"
+                ) from e
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code != 413:
+                    raise
+                logging.warning("Batch append exceeded the request size limit, retrying per patch")
+                response = await self._patch_invoices(user_id, batch_patches)
+        return response
+
+    async def store_invoices(self, user_id: str, invoices: List[InvoiceDict]) -> Dict[str, Any]:
+        """Store multiple invoices under the same user_id"""
+        try:
+            try:
+                # Append server-side instead of rewriting the whole document
+                response = await self._append_invoices(user_id, invoices)
+                logging.info(f"Updated invoices for user_id: {user_id}")
+            except exceptions.CosmosResourceNotFoundError:
+                # Create new user document
+                user_doc = {
+                    'id': user_id,
+                    'userId': user_id,
+                    'invoices': invoices
+                }
+                try:
+                    response = await self._with_retry(
+                        self.container.create_item,
+                        body=user_doc
+                    )
+                    logging.info(f"Created new user document for user_id: {user_id}")
+                except exceptions.CosmosResourceExistsError:
+                    # A concurrent request created the document first
+                    response = await self._append_invoices(user_id, invoices)
+                    logging.info(f"Updated invoices for user_id: {user_id}")
+
+            return response
+
+        except exceptions.CosmosHttpResponseError as e:
+            logging.error(f"Cosmos DB error: {str(e)}")
+            raise
+        except Exception as e:
+            logging.error(f"Error storing invoices: {str(e)}")
+            raise
+
     async def get_user_document(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Retrieve the user document by user_id"""
         try:
             # Read the document by id and partition key
-            response = await asyncio.to_thread(
-                self.container.read_item,
+            response = await self.container.read_item(
                 item=user_id,
                 partition_key=user_id
             )
@@ -111,10 +165,21 @@ class CosmosDBManager:
 
 # Singleton instance
 _cosmos_manager: Optional[CosmosDBManager] = None
+_cosmos_manager_lock = asyncio.Lock()
 
 async def get_cosmos_manager() -> CosmosDBManager:
     """Get or create CosmosDBManager instance"""
     global _cosmos_manager
     if _cosmos_manager is None:
-        _cosmos_manager = await CosmosDBManager().initialize()
-    return _cosmos_manager
\ No newline at end of file
+        # Only one coroutine creates the client; the rest wait and reuse it
+        async with _cosmos_manager_lock:
+            if _cosmos_manager is None:
+                _cosmos_manager = await CosmosDBManager().initialize()
+    return _cosmos_manager
+
+async def close_cosmos_manager():
+    """Close the CosmosDBManager instance if one was created"""
+    global _cosmos_manager
+    if _cosmos_manager is not None:
+        await _cosmos_manager.close()
+        _cosmos_manager = None
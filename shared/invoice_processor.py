@@ -1,24 +1,101 @@
 import os
-import json
+import re
+import logging
+import orjson
+import tiktoken
 import asyncio
-from openai import AsyncOpenAI
-from azure.ai.formrecognizer import DocumentAnalysisClient
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from operator import itemgetter
+import httpx
+from openai import (
+    AsyncOpenAI, DefaultAsyncHttpxClient, AuthenticationError,
+    BadRequestError, NotFoundError, PermissionDeniedError
+)
+from azure.ai.formrecognizer.aio import DocumentAnalysisClient
 from azure.core.credentials import AzureKeyCredential
 
 
+logger = logging.getLogger(__name__)
+
+GPT_MODEL = "gpt-4o-mini"
+
+# Page content above this many tokens is split before being sent to GPT.
+# The limit is set by the response: every extracted line item costs far more
+# output tokens than input tokens, and output is capped by max_tokens
+MAX_CHUNK_TOKENS = int(os.getenv("MAX_CHUNK_TOKENS", "4000"))
+
+# Height of the bands lines are grouped into by y, per page unit. Form
+# Recognizer reports PDF coordinates in inches and image coordinates in pixels
+LINE_BAND_SIZE = {"inch": 0.1, "pixel": 10}
+
 # Initialize clients
 document_analysis_client = DocumentAnalysisClient(
     endpoint=os.environ["AZURE_FORM_RECOGNIZER_ENDPOINT"],
     credential=AzureKeyCredential(os.environ["AZURE_FORM_RECOGNIZER_KEY"])
 )
 
-openai_client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+# One pooled HTTP/2 connection set shared by every GPT request in this worker,
+# so concurrent chunks multiplex over warm connections instead of new handshakes
+openai_http_client = DefaultAsyncHttpxClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+)
+
+# The client retries connection errors, 408/409/429 and 5xx responses with
+# exponential backoff and jitter; the timeout applies to each read of a stream
+openai_client = AsyncOpenAI(
+    api_key=os.environ["OPENAI_API_KEY"],
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "3")),
+    timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+    http_client=openai_http_client
+)
+
+async def close_clients():
+    """Close the Form Recognizer and OpenAI clients and their connection pools"""
+    await document_analysis_client.close()
+    await openai_client.close()
+
+# Misconfiguration (bad key, no access, wrong model) fails every chunk the same
+# way, so these propagate to the caller instead of reading as "no invoices"
+GPT_CONFIG_ERRORS = (AuthenticationError, PermissionDeniedError, NotFoundError)
+
+# Caps in-flight GPT requests per worker process now that all chunks of a
+# document are sent at once; the total across Gunicorn workers is this times workers
+gpt_semaphore = asyncio.Semaphore(int(os.getenv("MAX_PARALLEL_GPT_REQUESTS", "16")))
+
+# Per-process LRU of GPT response text, keyed by a hash of the full prompt
+GPT_CACHE_SIZE = int(os.getenv("GPT_CACHE_SIZE", "256"))
+gpt_cache = OrderedDict()
+
+def gpt_cache_key(page_data):
+    """Hash everything that determines the GPT response"""
+    hasher = prompt_hasher.copy()
+    hasher.update(page_data.encode())
+    return hasher.hexdigest()
+
+def cache_gpt_response(key, content):
+    """Store response text, evicting the least recently used entry when full"""
+    gpt_cache[key] = content
+    gpt_cache.move_to_end(key)
+    if len(gpt_cache) > GPT_CACHE_SIZE:
+        gpt_cache.popitem(last=False)
+
+# Matches the C0/C1 control characters that are not whitespace
+CONTROL_CHARS = re.compile('[%s]' % ''.join(
+    re.escape(chr(code)) for code in (*range(0x20), *range(0x7f, 0xa0))
+    if not (chr(code).isprintable() or chr(code).isspace())
+))
 
 def clean_text(content):
     """Clean text content efficiently"""
     if not content:
         return ""
-    return ''.join(char for char in content if char.isprintable() or char.isspace()).strip()
+    # Most lines are already printable, which str.isprintable checks in C
+    if content.isprintable():
+        return content.strip()
+    return CONTROL_CHARS.sub('', content).strip()
 
 def parse_json_safely(text):
     """Parse JSON with better error handling"""
@@ -26,66 +103,74 @@ def parse_json_safely(text):
         # Remove markdown if present
         if "```" in text:
             text = text[text.find('{'):text.rfind('}')+1]
-        return json.loads(text)
-    except json.JSONDecodeError:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         return None
 
-async def send_to_gpt(page_data, retries=3):
-    """Send data to GPT with better retry handling"""
-    delay = 1
-    for attempt in range(retries):
-        try:
-            response = await openai_client.chat.completions.create(
-                model="gpt-4o-mini",
+async def send_to_gpt(page_data):
+    """Send data to GPT; transient failures are retried by the OpenAI client"""
+    # Cached text is re-parsed so callers never share (and mutate) one result
+    cache_key = gpt_cache_key(page_data)
+    cached = gpt_cache.get(cache_key)
+    if cached is not None:
+        gpt_cache.move_to_end(cache_key)
+        return parse_json_safely(cached)
+
+    try:
+        async with gpt_semaphore:
+            stream = await openai_client.chat.completions.create(
+                model=GPT_MODEL,
                 messages=[
-                    {"role": "system", "content": system_message},
+                    system_chat_message,
                     {"role": "user", "content": prompt + page_data}
                 ],
                 max_tokens=16000,
-                temperature=0.1
+                temperature=0.1,
+                stream=True,
+                stream_options={"include_usage": True}
             )
-            
-            if response and response.choices:
-                content = clean_text(response.choices[0].message.content)
-                return parse_json_safely(content)
-                
-        except Exception as e:
-            if attempt == retries - 1:
-                print(f"GPT processing failed: {str(e)}")
-                return None
-            await asyncio.sleep(delay)
-            delay *= 2
-    
-    return None
+            # Collect tokens as they arrive instead of waiting for the full body
+            parts = []
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                if chunk.usage:
+                    logger.info(
+                        f"GPT usage: {chunk.usage.prompt_tokens} prompt tokens, "
+                        f"{chunk.usage.completion_tokens} completion tokens"
+                    )
+    # A rejected chunk fails only itself; errors raised while reading the
+    # stream come from httpx unwrapped. Anything else propagates
+    except (BadRequestError, httpx.HTTPError) as e:
+        logger.error(f"GPT processing failed: {str(e)}")
+        return None
+
+    if not parts:
+        return None
+
+    content = clean_text(''.join(parts))
+    result = parse_json_safely(content)
+    # Only cache responses that parsed, so failures are retried
+    if result is not None:
+        cache_gpt_response(cache_key, content)
+    return result
 
 def process_table_cells(table):
     """Process table cells more efficiently"""
-    rows = {}
+    # Fill a pre-sized grid by index, then join each row as tab-separated text
+    grid = [[''] * table.column_count for _ in range(table.row_count)]
     for cell in table.cells:
-        row_idx = cell.row_index
-        col_idx = cell.column_index
-        
-        if row_idx not in rows:
-            rows[row_idx] = {}
-        rows[row_idx][col_idx] = clean_text(cell.content)
-
-    table_text = []
-    for row_idx in sorted(rows.keys()):
-        row = rows[row_idx]
-        # Convert row to tab-separated string
-        row_text = '\t'.join(row.get(i, '') for i in range(max(row.keys()) + 1))
-        table_text.append(row_text)
-    
-    return '\n'.join(table_text)
+        grid[cell.row_index][cell.column_index] = clean_text(cell.content)
 
-def extract_document_content(file_path):
-    """Extract content from document with better structure"""
+    return '\n'.join('\t'.join(row) for row in grid)
+
+async def extract_document_content(document):
+    """Extract content from document (bytes or binary stream) with better structure"""
     try:
-        with open(file_path, "rb") as doc:
-            poller = document_analysis_client.begin_analyze_document(
-                "prebuilt-layout", doc
-            )
-            result = poller.result()
+        poller = await document_analysis_client.begin_analyze_document(
+            "prebuilt-layout", document
+        )
+        result = await poller.result()
 
         pages = {}
         
@@ -97,15 +182,18 @@ def extract_document_content(file_path):
                 'tables': []
             }
             
-            # Extract and sort text by position
-            text_lines = []
-            for line in page.lines:
-                y_pos = min(p.y for p in line.polygon)
-                x_pos = min(p.x for p in line.polygon)
-                text_lines.append((y_pos, x_pos, clean_text(line.content)))
+            # Extract and sort text by position. The first polygon point is the
+            # top-left corner; rounding y groups lines into bands of 0.1 inch
+            # (PDFs) or 10 pixels (images) so text on the same visual row is
+            # ordered left to right
+            band = LINE_BAND_SIZE.get(page.unit, 0.1)
+            text_lines = [
+                (round(line.polygon[0].y / band), line.polygon[0].x, clean_text(line.content))
+                for line in page.lines
+            ]
             
             # Sort and store text
-            text_lines.sort()  # Will sort by y_pos, then x_pos
+            text_lines.sort(key=itemgetter(0, 1))
             pages[page_num]['text'] = [line[2] for line in text_lines]
 
         # Process tables
@@ -124,36 +212,48 @@ def format_content(page_data, page_num):
     """Format page content more efficiently"""
     content = [f"\n----- Page {page_num} Start -----\n"]
     
-    # Add text content
+    # Add text content as one block
     if page_data['text']:
-        content.append("TEXT CONTENT:")
-        content.extend(f"{i}:{line}" for i, line in enumerate(page_data['text'], 1))
+        content.append("TEXT CONTENT:\n" + '\n'.join(
+            f"{i}:{line}" for i, line in enumerate(page_data['text'], 1)
+        ))
     
-    # Add tables
+    # Add each table as one block
     for idx, table in enumerate(page_data['tables'], 1):
-        content.extend([
+        header, newline, body = table.partition('\n')
+        rows = body.split('\n') if newline else []
+        content.append('\n'.join([
             f"\n----- Table {idx} Start -----\n",
-            f"Header: {table.split(chr(10))[0]}"  # Using chr(10) instead of '\n'
-        ])
-        
-        # Add table rows
-        rows = table.split(chr(10))[1:]  # Using chr(10) instead of '\n'
-        content.extend(f"Row {i}: {row}" for i, row in enumerate(rows, 1))
-        content.append(f"----- Table {idx} End -----\n")
+            f"Header: {header}",
+            *[f"Row {i}: {row}" for i, row in enumerate(rows, 1)],
+            f"----- Table {idx} End -----\n"
+        ]))
     
     content.append(f"----- Page {page_num} End -----\n")
     return '\n'.join(content)
 
-async def process_large_content(content, chunk_size=14000):
-    """Process large content in chunks more efficiently"""
+@lru_cache(maxsize=None)
+def get_encoding():
+    """Load the GPT model's tokenizer once per process"""
+    return tiktoken.encoding_for_model(GPT_MODEL)
+
+def split_content(content, max_tokens=MAX_CHUNK_TOKENS):
+    """Split content on line boundaries into chunks of at most max_tokens tokens"""
+    encoding = get_encoding()
+    if len(encoding.encode_ordinary(content)) <= max_tokens:
+        return [content]
+
+    lines = content.split('\n')
+    line_tokens = [len(tokens) for tokens in encoding.encode_ordinary_batch(lines)]
+
     chunks = []
     current_chunk = []
     current_size = 0
     
-    for line in content.split('\n'):
-        line_size = len(line) + 1  # +1 for newline
+    for line, line_size in zip(lines, line_tokens):
+        line_size += 1  # +1 for newline
         
-        if current_size + line_size > chunk_size and current_chunk:
+        if current_size + line_size > max_tokens and current_chunk:
             chunks.append('\n'.join(current_chunk))
             current_chunk = []
             current_size = 0
@@ -164,9 +264,7 @@ async def process_large_content(content, chunk_size=14000):
     if current_chunk:
         chunks.append('\n'.join(current_chunk))
     
-    # Process chunks concurrently
-    tasks = [send_to_gpt(chunk) for chunk in chunks]
-    return await asyncio.gather(*tasks)
+    return chunks
 
 def merge_invoice_items(current, new_items):
     """Merge invoice items more efficiently"""
@@ -179,72 +277,65 @@ def merge_invoice_items(current, new_items):
     current.extend(new_items)
     return current
 
-async def process_invoice_with_gpt(file_path):
+async def process_invoice_with_gpt(document):
     """Process invoice with better error handling and efficiency"""
     try:
         # Extract document content
-        pages = extract_document_content(file_path)
+        pages = await extract_document_content(document)
         if not pages:
             return None
 
-        all_invoices = []
-        current_invoice = None
-        
-        # Process each page
+        # Collect chunks across all pages so they can be sent concurrently
+        chunks = []
         for page_num in sorted(pages.keys()):
             page_content = format_content(pages[page_num], page_num)
-            
-            # Handle large content
-            if len(page_content) > 14000:
-                results = await process_large_content(page_content)
-                for result in results:
-                    if result:
-                        if current_invoice:
-                            # Merge items if same invoice
-                            if result.get('Invoice Number') == current_invoice.get('Invoice Number'):
-                                current_invoice['List of Items'] = merge_invoice_items(
-                                    current_invoice['List of Items'],
-                                    result.get('List of Items', [])
-                                )
-                                # Update total if needed
-                                if result.get('Total'):
-                                    current_invoice['Total'] = result['Total']
-                            else:
-                                all_invoices.append(current_invoice)
-                                current_invoice = result
-                        else:
-                            current_invoice = result
-            else:
-                # Process normal sized content
-                result = await send_to_gpt(page_content)
-                if result:
-                    if current_invoice:
-                        if result.get('Invoice Number') == current_invoice.get('Invoice Number'):
-                            current_invoice['List of Items'] = merge_invoice_items(
-                                current_invoice['List of Items'],
-                                result.get('List of Items', [])
-                            )
-                            if result.get('Total'):
-                                current_invoice['Total'] = result['Total']
-                        else:
-                            all_invoices.append(current_invoice)
-                            current_invoice = result
-                    else:
-                        current_invoice = result
-        
-        # Add last invoice
-        if current_invoice:
-            all_invoices.append(current_invoice)
+            chunks.extend(split_content(page_content))
+
+        results = await asyncio.gather(
+            *[send_to_gpt(chunk) for chunk in chunks],
+            return_exceptions=True
+        )
+
+        # Merge results by invoice number; dicts keep first-seen (page) order
+        invoices_by_number = {}
+        for result in results:
+            if isinstance(result, GPT_CONFIG_ERRORS):
+                raise result
+            if isinstance(result, Exception):
+                logger.error(f"Error processing chunk: {str(result)}")
+                continue
+            if not result:
+                continue
+            # The prompt asks for an array of invoices, but a single object is accepted too
+            for invoice in (result if isinstance(result, list) else [result]):
+                if not isinstance(invoice, dict):
+                    logger.warning(f"Skipping non-object invoice in GPT response: {invoice!r}")
+                    continue
+                key = invoice.get('Invoice Number') or id(invoice)
+                existing = invoices_by_number.get(key)
+                if existing is None:
+                    invoices_by_number[key] = invoice
+                    continue
+                existing['List of Items'] = merge_invoice_items(
+                    existing.get('List of Items'),
+                    invoice.get('List of Items', [])
+                )
+                # Update total if needed
+                if invoice.get('Total'):
+                    existing['Total'] = invoice['Total']
         
-        return all_invoices
+        return list(invoices_by_number.values())
         
+    except GPT_CONFIG_ERRORS:
+        raise
     except Exception as e:
         return None
 
 async def main():
     try:
         file_path = "C:/Users/rahul/Downloads/RESTAURANT DEPOT INVOICE 4.pdf"
-        results = await process_invoice_with_gpt(file_path)
+        with open(file_path, "rb") as document:
+            results = await process_invoice_with_gpt(document)
         
         if results:
             print(f"Successfully processed {len(results)} invoices")
@@ -533,5 +624,11 @@ DETAILED INVOICE ANALYSIS INSTRUCTIONS:
 
 OUTPUT FORMAT:
 Return a JSON array containing each invoice as an object matching this template:
-{json.dumps(json_template, indent=2)}INVOICE TEXT TO PROCESS:
+{orjson.dumps(json_template, option=orjson.OPT_INDENT_2).decode()}INVOICE TEXT TO PROCESS:
 """    
+
+# Invariant parts of every GPT request, built once at import. Keeping the
+# system message and prompt byte-identical at the start of each request
+# also lets OpenAI reuse its cached prompt prefix.
+system_chat_message = {"role": "system", "content": system_message}
+prompt_hasher = hashlib.blake2b((system_message + prompt).encode(), digest_size=16)
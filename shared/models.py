@@ -1,7 +1,105 @@
-from typing import List, Dict, Any
-from dataclasses import dataclass, field
+import sys
+from typing import List, Dict, Any, Tuple, TypedDict
+from dataclasses import dataclass, field, fields
+import orjson
 
-@dataclass
+# Shapes of the plain dicts produced by GPT extraction and stored in Cosmos.
+# The processing pipeline passes these through as-is; the dataclasses below
+# are for callers that want typed objects. Keys are optional because GPT
+# output may omit fields.
+InvoiceItemDict = TypedDict('InvoiceItemDict', {
+    'Item Number': str,
+    'Item Name': str,
+    'Product Category': str,
+    'Quantity In a Case': float,
+    'Measurement Of Each Item': float,
+    'Measured In': str,
+    'Quantity Shipped': float,
+    'Extended Price': float,
+    'Total Units Ordered': float,
+    'Case Price': float,
+    'Catch Weight': str,
+    'Priced By': str,
+    'Splitable': str,
+    'Split Price': str,
+    'Cost of a Unit': float,
+    'Cost of Each Item': float,
+    'Currency': str,
+}, total=False)
+
+InvoiceDict = TypedDict('InvoiceDict', {
+    'Supplier Name': str,
+    'Sold to Address': str,
+    'Order Date': str,
+    'Ship Date': str,
+    'Invoice Number': str,
+    'Shipping Address': str,
+    'Total': float,
+    'List of Items': List[InvoiceItemDict],
+}, total=False)
+
+def _str_or_empty(value: Any) -> str:
+    """str() that maps a missing value or JSON null to ''"""
+    return '' if value is None else str(value)
+
+def _intern_str(value: Any) -> str:
+    """str() for low-cardinality fields, shared across items via sys.intern"""
+    return sys.intern(str(value))
+
+# (JSON key, attribute, caster, default) for each InvoiceItem field, in field order.
+# Fields with a handful of distinct values (units, flags, currency) are interned
+# so every item shares one string object per value
+_ITEM_SPEC = (
+    ('Item Number', 'Item_Number', str, ''),
+    ('Item Name', 'Item_Name', str, ''),
+    ('Product Category', 'Product_Category', str, ''),
+    ('Quantity In a Case', 'Quantity_In_a_Case', float, 0.0),
+    ('Measurement Of Each Item', 'Measurement_Of_Each_Item', float, 0.0),
+    ('Measured In', 'Measured_In', _intern_str, ''),
+    ('Quantity Shipped', 'Quantity_Shipped', float, 0.0),
+    ('Extended Price', 'Extended_Price', float, 0.0),
+    ('Total Units Ordered', 'Total_Units_Ordered', float, 0.0),
+    ('Case Price', 'Case_Price', float, 0.0),
+    ('Catch Weight', 'Catch_Weight', _intern_str, ''),
+    ('Priced By', 'Priced_By', _intern_str, ''),
+    ('Splitable', 'Splitable', _intern_str, ''),
+    ('Split Price', 'Split_Price', str, ''),
+    ('Cost of a Unit', 'Cost_of_a_Unit', float, 0.0),
+    ('Cost of Each Item', 'Cost_of_Each_Item', float, 0.0),
+    ('Currency', 'Currency', _intern_str, ''),
+)
+
+def _compile_function(name: str, source: str, qualname: str = None, **namespace: Any):
+    """Compile generated source and return the function it defines"""
+    # __name__ gives the function this module's __module__ for tracebacks and pickling
+    namespace.update(Dict=Dict, Any=Any, _intern=sys.intern, __name__=__name__)
+    exec(source, namespace)
+    fn = namespace[name]
+    fn.__qualname__ = qualname or name
+    return fn
+
+# Source template for each caster, so generated code calls builtins directly
+_CAST_SOURCE = {
+    str: '(str(value) if (value := {get}) is not None else {default!r})',
+    float: 'float({get} or {default!r})',
+    _intern_str: '(_intern(str(value)) if (value := {get}) is not None else {default!r})',
+}
+
+def _constructor_args(obj: str, spec) -> str:
+    """Source for positional arguments casting each JSON key in spec read from dict obj"""
+    # Missing keys and JSON nulls take the default; str() would turn null into
+    # 'None' and float() would reject it. Only numeric fields use 'or', since
+    # a falsy string value such as 0 must stay '0'
+    return ', '.join(
+        _CAST_SOURCE[caster].format(get=f'{obj}.get({key!r})', default=default)
+        for key, _, caster, default in spec
+    )
+
+def _dict_literal(obj: str, spec) -> str:
+    """Source for a dict literal mapping each JSON key in spec to obj.<attribute>"""
+    return '{' + ', '.join(f'{key!r}: {obj}.{attr}' for key, attr, _, _ in spec) + '}'
+
+@dataclass(slots=True)
 class InvoiceItem:
     Item_Number: str
     Item_Name: str
@@ -21,50 +119,42 @@ class InvoiceItem:
     Cost_of_Each_Item: float
     Currency: str
 
+    # Generated from _ITEM_SPEC with each cast inlined as a positional argument
+    from_dict = classmethod(_compile_function('from_dict', f"""
+def from_dict(cls, data: Dict[str, Any]) -> 'InvoiceItem':
+    return cls({_constructor_args('data', _ITEM_SPEC)})
+""", qualname='InvoiceItem.from_dict'))
+
     @classmethod
-    def from_dict(cls, data: Dict[str, Any]) -> 'InvoiceItem':
-        return cls(
-            Item_Number=str(data.get('Item Number', '')),
-            Item_Name=str(data.get('Item Name', '')),
-            Product_Category=str(data.get('Product Category', '')),
-            Quantity_In_a_Case=float(data.get('Quantity In a Case', 0.0)),
-            Measurement_Of_Each_Item=float(data.get('Measurement Of Each Item', 0.0)),
-            Measured_In=str(data.get('Measured In', '')),
-            Quantity_Shipped=float(data.get('Quantity Shipped', 0.0)),
-            Extended_Price=float(data.get('Extended Price', 0.0)),
-            Total_Units_Ordered=float(data.get('Total Units Ordered', 0.0)),
-            Case_Price=float(data.get('Case Price', 0.0)),
-            Catch_Weight=str(data.get('Catch Weight', '')),
-            Priced_By=str(data.get('Priced By', '')),
-            Splitable=str(data.get('Splitable', '')),
-            Split_Price=str(data.get('Split Price', '')),
-            Cost_of_a_Unit=float(data.get('Cost of a Unit', 0.0)),
-            Cost_of_Each_Item=float(data.get('Cost of Each Item', 0.0)),
-            Currency=str(data.get('Currency', ''))
-        )
+    def from_tuple(cls, values: Tuple[Any, ...]) -> 'InvoiceItem':
+        """Build an item from values already in field order (e.g. a CSV row)"""
+        return cls(*values)
 
-    def to_dict(self) -> Dict[str, Any]:
-        return {
-            'Item Number': self.Item_Number,
-            'Item Name': self.Item_Name,
-            'Product Category': self.Product_Category,
-            'Quantity In a Case': self.Quantity_In_a_Case,
-            'Measurement Of Each Item': self.Measurement_Of_Each_Item,
-            'Measured In': self.Measured_In,
-            'Quantity Shipped': self.Quantity_Shipped,
-            'Extended Price': self.Extended_Price,
-            'Total Units Ordered': self.Total_Units_Ordered,
-            'Case Price': self.Case_Price,
-            'Catch Weight': self.Catch_Weight,
-            'Priced By': self.Priced_By,
-            'Splitable': self.Splitable,
-            'Split Price': self.Split_Price,
-            'Cost of a Unit': self.Cost_of_a_Unit,
-            'Cost of Each Item': self.Cost_of_Each_Item,
-            'Currency': self.Currency
-        }
-
-@dataclass
+    # Generated from _ITEM_SPEC as a single dict literal
+    to_dict = _compile_function('to_dict', f"""
+def to_dict(self) -> Dict[str, Any]:
+    return {_dict_literal('self', _ITEM_SPEC)}
+""", qualname='InvoiceItem.to_dict')
+
+# Positional construction relies on _ITEM_SPEC listing fields in declaration order
+if tuple(f.name for f in fields(InvoiceItem)) != tuple(attr for _, attr, _, _ in _ITEM_SPEC):
+    raise TypeError("_ITEM_SPEC is out of sync with InvoiceItem fields")
+
+# Serializes a list of items with the item dict literal inlined, avoiding a
+# to_dict call per item; every field is a str or float, so nothing is copied
+_items_to_dicts = _compile_function('_items_to_dicts', f"""
+def _items_to_dicts(items):
+    return [{_dict_literal('item', _ITEM_SPEC)} for item in items]
+""")
+
+# Builds every item of an invoice in one comprehension with the casts inlined,
+# avoiding a from_dict call per item
+_items_from_dicts = _compile_function('_items_from_dicts', f"""
+def _items_from_dicts(items_data):
+    return [InvoiceItem({_constructor_args('item', _ITEM_SPEC)}) for item in items_data]
+""", InvoiceItem=InvoiceItem)
+
+@dataclass(slots=True)
 class Invoice:
     Supplier_Name: str
     Sold_to_Address: str
@@ -77,19 +167,22 @@ class Invoice:
 
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'Invoice':
-        items_data = data.get('List of Items', [])
-        items = [InvoiceItem.from_dict(item) for item in items_data]
+        items = _items_from_dicts(data.get('List of Items') or [])
         return cls(
-            Supplier_Name=str(data.get('Supplier Name', '')),
-            Sold_to_Address=str(data.get('Sold to Address', '')),
-            Order_Date=str(data.get('Order Date', '')),
-            Ship_Date=str(data.get('Ship Date', '')),
-            Invoice_Number=str(data.get('Invoice Number', '')),
-            Shipping_Address=str(data.get('Shipping Address', '')),
-            Total=float(data.get('Total', 0.0)),
+            Supplier_Name=_str_or_empty(data.get('Supplier Name')),
+            Sold_to_Address=_str_or_empty(data.get('Sold to Address')),
+            Order_Date=_str_or_empty(data.get('Order Date')),
+            Ship_Date=_str_or_empty(data.get('Ship Date')),
+            Invoice_Number=_str_or_empty(data.get('Invoice Number')),
+            Shipping_Address=_str_or_empty(data.get('Shipping Address')),
+            Total=float(data.get('Total') or 0.0),
             Items=items
         )
 
+    @classmethod
+    def from_json_bytes(cls, buf: bytes) -> 'Invoice':
+        return cls.from_dict(orjson.loads(buf))
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             'Supplier Name': self.Supplier_Name,
@@ -99,5 +192,5 @@ class Invoice:
             'Invoice Number': self.Invoice_Number,
             'Shipping Address': self.Shipping_Address,
             'Total': self.Total,
-            'List of Items': [item.to_dict() for item in self.Items]
+            'List of Items': _items_to_dicts(self.Items)
         }
\ No newline at end of file